@@ -0,0 +1,251 @@
+"""
+Exceedance counts and rolling statistics for all monitoring sites at once.
+
+All calculations work on a sites x time matrix of hourly values, so every site is handled
+in the same numpy operation instead of looping over sites with pandas.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# air quality limits per species: (description, averaging window in hours, limit value)
+# values are in ug/m3, except for CO which is in mg/m3 (same as the csv columns)
+EXCEEDANCE_LIMITS = {
+    "NO2": [("UK 1-hour mean", 1, 200),
+            ("WHO 24-hour mean", 24, 25)],
+    "PM25": [("WHO 24-hour mean", 24, 15)],
+    "PM10": [("UK 24-hour mean", 24, 50),
+             ("WHO 24-hour mean", 24, 45)],
+    "O3": [("UK 8-hour mean", 8, 100)],
+    "SO2": [("UK 1-hour mean", 1, 350),
+            ("UK 24-hour mean", 24, 125)],
+    "CO": [("UK 8-hour mean", 8, 10)],
+}
+
+ROLLING_WINDOWS = (8, 24)  # hours
+
+
+def site_matrix(sites_dict: dict, species_col: str, site_codes: list = None) -> tuple:
+    """
+    Puts the hourly values of one pollutant for all sites in a single matrix.
+    :param sites_dict: dictionary where key = site code, and value = dataframe with site data
+    :param species_col: column name of the pollutant in the site dataframes
+    :param site_codes: sites to include, defaults to all sites in sites_dict. Sites without the column are skipped
+    :return: list of site codes (rows), DatetimeIndex with every hour (columns), matrix of shape (sites, hours)
+    """
+    if site_codes is None:
+        site_codes = list(sites_dict.keys())
+
+    site_series = {}
+    for site_code in site_codes:
+        if site_code not in sites_dict or species_col not in sites_dict[site_code].columns:
+            continue
+        series = sites_dict[site_code][species_col]
+        site_series[site_code] = series[~series.index.duplicated()]
+
+    if not site_series:
+        return [], pd.DatetimeIndex([]), np.empty((0, 0))
+
+    start = min(x.index.min() for x in site_series.values())
+    end = max(x.index.max() for x in site_series.values())
+    times = pd.date_range(start, end, freq=pd.Timedelta(hours=1))  # gaps in the data become nan
+
+    matrix = np.full((len(site_series), len(times)), np.nan)
+    for i, series in enumerate(site_series.values()):
+        matrix[i, times.get_indexer(series.index)] = series.to_numpy(dtype=float)
+
+    return list(site_series.keys()), times, matrix
+
+
+def rolling_mean(matrix: np.ndarray, window: int, min_periods: int = None) -> np.ndarray:
+    """
+    Running mean over the last `window` columns for every row, using cumulative sums.
+    :param matrix: sites x hours matrix, nan for missing values
+    :param window: number of hours to average over
+    :param min_periods: minimum number of valid hours in a window, defaults to 75% of the window
+    :return: matrix of the same shape, nan where there is not enough data
+    """
+    if min_periods is None:
+        min_periods = math.ceil(window * 0.75)  # usual data capture requirement
+
+    valid = ~np.isnan(matrix)
+
+    # prepend `window` zero columns, so window sums are simply cumsum[i + window] - cumsum[i]
+    zeros = np.zeros((matrix.shape[0], window))
+    value_sums = np.concatenate([zeros, np.cumsum(np.where(valid, matrix, 0), axis=1)], axis=1)
+    count_sums = np.concatenate([zeros, np.cumsum(valid, axis=1)], axis=1)
+
+    window_sums = value_sums[:, window:] - value_sums[:, :-window]
+    window_counts = count_sums[:, window:] - count_sums[:, :-window]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = window_sums / window_counts
+    means[window_counts < max(min_periods, 1)] = np.nan
+
+    return means
+
+
+def by_day(matrix: np.ndarray, times: pd.DatetimeIndex) -> tuple:
+    """
+    Splits the hourly columns of a matrix into calendar days, padding the first and last day with nan.
+    :param matrix: sites x hours matrix, nan for missing values
+    :param times: time per column of the matrix, every hour
+    :return: DatetimeIndex with the start of every day, matrix of shape (sites, days, 24)
+    """
+    if not len(times):
+        return pd.DatetimeIndex([]), np.empty((matrix.shape[0], 0, 24))
+
+    first_day = times[0].normalize()
+    lead = (times[0] - first_day) // pd.Timedelta(hours=1)  # hours between midnight and the first column
+    trail = -(lead + len(times)) % 24
+
+    padded = np.pad(matrix, ((0, 0), (lead, trail)), constant_values=np.nan)
+    days = pd.date_range(first_day, periods=padded.shape[1] // 24, freq="D")
+
+    return days, padded.reshape(matrix.shape[0], len(days), 24)
+
+
+def daily_means(matrix: np.ndarray, times: pd.DatetimeIndex, min_periods: int = 18) -> tuple:
+    """
+    Mean per calendar day for every row.
+    :param matrix: sites x hours matrix, nan for missing values
+    :param times: time per column of the matrix, every hour
+    :param min_periods: minimum number of valid hours in a day, defaults to 75% of the day
+    :return: DatetimeIndex with the start of every day, sites x days matrix, nan where there is not enough data
+    """
+    days, day_values = by_day(matrix, times)
+
+    valid = ~np.isnan(day_values)
+    counts = np.sum(valid, axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.sum(np.where(valid, day_values, 0), axis=2) / counts
+    means[counts < max(min_periods, 1)] = np.nan
+
+    return days, means
+
+
+def exceedance_counts(matrix: np.ndarray, times: pd.DatetimeIndex, limit: float, window: int = 1,
+                      rolling: dict = None) -> np.ndarray:
+    """
+    Number of exceedances per site, counted the way the limit is defined:
+    - 1-hour limits: hours with a value above the limit (objectives allow a number of hours per year)
+    - 8-hour limits: days on which the highest running 8-hour mean is above the limit
+    - 24-hour limits: days with a calendar day mean above the limit
+    :param matrix: sites x hours matrix, nan for missing values
+    :param times: time per column of the matrix, every hour
+    :param limit: limit value, in the same unit as the matrix
+    :param window: averaging window of the limit in hours, 1 = hourly values
+    :param rolling: already calculated running means of the matrix, key = window, value = rolling_mean() result
+    :return: array with a count per site
+    """
+    if window == 1:
+        means = matrix
+    elif window == 24:
+        means = daily_means(matrix, times)[1]
+    else:
+        hourly = rolling[window] if rolling is not None and window in rolling else rolling_mean(matrix, window)
+        means = by_day(hourly, times)[1]  # a day exceeds the limit if its highest value does
+
+    with np.errstate(invalid="ignore"):
+        exceeded = means > limit
+
+    if exceeded.ndim == 3:
+        exceeded = np.any(exceeded, axis=2)
+
+    return np.sum(exceeded, axis=1)
+
+
+def site_statistics(sites_dict: dict, species_code: str, species_col: str, site_codes: list = None) -> dict:
+    """
+    Exceedance counts and rolling mean summary for every site tracking a pollutant.
+    :param sites_dict: dictionary where key = site code, and value = dataframe with site data
+    :param species_code: options are NO2, O3, PM10, SO2, PM25, CO
+    :param species_col: column name of the pollutant in the site dataframes
+    :param site_codes: sites to include, defaults to all sites in sites_dict
+    :return: json serialisable dictionary with the limits used and statistics per site code
+    """
+    codes, times, matrix = site_matrix(sites_dict, species_col, site_codes)
+
+    return matrix_statistics(codes, times, matrix, species_code)
+
+
+def matrix_statistics(codes: list, times: pd.DatetimeIndex, matrix: np.ndarray, species_code: str,
+                      block_size: int = 32) -> dict:
+    """
+    Exceedance counts and rolling mean summary for every row of a sites x hours matrix.
+    Rows are processed in blocks, so only the running means of a few sites are in memory at once.
+    :param codes: site code per row of the matrix
+    :param times: time per column of the matrix
+    :param matrix: sites x hours matrix, as returned by site_matrix()
+    :param species_code: options are NO2, O3, PM10, SO2, PM25, CO
+    :param block_size: number of rows per block
+    :return: json serialisable dictionary with the limits used and statistics per site code
+    """
+    limits = EXCEEDANCE_LIMITS.get(species_code, [])
+
+    sites = {}
+    for block_start in range(0, len(codes), block_size):
+        block = np.asarray(matrix[block_start:block_start + block_size], dtype=float)
+        rolling = {window: rolling_mean(block, window) for window in ROLLING_WINDOWS}
+
+        counts = {name: exceedance_counts(block, times, limit, window, rolling=rolling)
+                  for name, window, limit in limits}
+        hours_measured = np.sum(~np.isnan(block), axis=1)
+        summaries = {window: (_row_max(means), _last_valid(means)) for window, means in rolling.items()}
+
+        for i, code in enumerate(codes[block_start:block_start + block_size]):
+            site_stats = {"exceedances": {name: int(counts[name][i]) for name, _, _ in limits},
+                          "hours_measured": int(hours_measured[i])}
+
+            for window, (max_means, latest_means) in summaries.items():
+                site_stats[f"max_{window}h_mean"] = _to_json_float(max_means[i])
+                site_stats[f"latest_{window}h_mean"] = _to_json_float(latest_means[i])
+
+            sites[code] = site_stats
+
+    return {
+        "species": species_code,
+        "start": str(times[0]) if len(times) else None,
+        "end": str(times[-1]) if len(times) else None,
+        "limits": [{"name": name, "window_hours": window, "limit": limit, "counted_in": counted_in(window)}
+                   for name, window, limit in limits],
+        "sites": sites,
+    }
+
+
+def counted_in(window: int) -> str:
+    """
+    Unit of the exceedance counts of a limit with the averaging window, see exceedance_counts().
+    """
+    return "hours" if window == 1 else "days"
+
+
+def _row_max(matrix: np.ndarray) -> np.ndarray:
+    """
+    Highest value that isn't nan in every row, nan for rows without any.
+    """
+    if not matrix.shape[1]:
+        return np.full(matrix.shape[0], np.nan)
+
+    return np.fmax.reduce(matrix, axis=1)
+
+
+def _last_valid(matrix: np.ndarray) -> np.ndarray:
+    """
+    Last value that isn't nan in every row, nan for rows without any.
+    """
+    valid = ~np.isnan(matrix)
+    if not matrix.shape[1]:
+        return np.full(matrix.shape[0], np.nan)
+
+    last = matrix.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    return np.where(valid.any(axis=1), matrix[np.arange(matrix.shape[0]), last], np.nan)
+
+
+def _to_json_float(value):
+    """
+    Rounded float, or None for nan (which is not valid json).
+    """
+    return None if np.isnan(value) else round(float(value), 2)
@@ -4,16 +4,44 @@ Running a local server to display the maps.
 To run: just run this file and follow the link it provides.
 
 Usually: http://localhost:5000.
+
+The map making stack (pandas, matplotlib, folium) is only imported once a map or statistic has to be
+calculated, so the app itself imports quickly. When run with gunicorn, gunicorn.conf.py imports the stack once
+in the master process before the workers are forked, and each worker opens the site data in the background.
 """
 
+import importlib
 import os
+import time
+import uuid
 
-from flask import Flask, render_template
+from flask import Flask, Response, abort, jsonify, render_template, request
 
-from mapmaking import create_layered_map
+from instrumentation import increment, render_metrics, span, trace
 
 app = Flask(__name__, template_folder=os.path.join(os.getcwd()))
 
+MAP_SPECIES = ["NO2", "PM10", "PM25"]  # pollutants with a map route
+
+
+def warm_up():
+    """
+    Imports the map making stack (pandas, matplotlib, folium), which takes a second or two.
+    :return:
+    """
+    importlib.import_module("mapmaking")
+
+
+def open_map_datasets():
+    """
+    Opens the site data of every pollutant with a map route, building the shared datasets if they are missing
+    or outdated. Takes a while on a cold start, so don't run it where it delays serving requests.
+    :return:
+    """
+    from shared_dataset import open_species_datasets
+
+    open_species_datasets(MAP_SPECIES)
+
 
 @app.route('/NO2_map')
 def NO2_map():
@@ -32,11 +60,68 @@ def PM25_map():
 
 def map(species_code):
     if os.path.isfile(f"ULEZ_map_{species_code}.html"):
+        increment("map_cache_hits")
         return render_template(f"ULEZ_map_{species_code}.html")
-    else:  # create new map if map doesn't already exist
+
+    increment("map_cache_misses")
+
+    # create new map if map doesn't already exist, set MAP_TRACE_DIR to save a trace of each build
+    trace_dir = os.environ.get("MAP_TRACE_DIR")
+    trace_name = f"trace_{species_code}_{time.time():.0f}_{os.getpid()}_{uuid.uuid4().hex[:8]}.json"
+    trace_path = os.path.join(trace_dir, trace_name) if trace_dir else None
+
+    with trace(trace_path):
+        from mapmaking import create_layered_map  # heavy import, only needed when building
+
         folium_map = create_layered_map(species_code, save=False)
 
-    return folium_map._repr_html_()
+        with span("render"):
+            return folium_map._repr_html_()
+
+
+@app.route('/api/exceedances/<species_code>')
+def exceedances(species_code):
+    """
+    Limit exceedance counts (in the unit given per limit) and rolling means per site, as json.
+    """
+    from analysis import EXCEEDANCE_LIMITS
+    from mapmaking import exceedance_statistics
+
+    if species_code not in EXCEEDANCE_LIMITS:
+        abort(404)
+
+    return jsonify(exceedance_statistics(species_code))
+
+
+@app.route('/api/rolling_mean/<species_code>/<site_code>')
+def rolling_mean(species_code, site_code):
+    """
+    Rolling mean over time for a single site, as json. Window (in hours) can be set with ?window=8 or ?window=24.
+    """
+    from analysis import EXCEEDANCE_LIMITS, ROLLING_WINDOWS
+    from mapmaking import rolling_mean_series
+
+    window = request.args.get("window", 24, type=int)
+    if species_code not in EXCEEDANCE_LIMITS or window not in ROLLING_WINDOWS:
+        abort(404)
+
+    series = rolling_mean_series(species_code, site_code, window=window)
+    if series is None:  # unknown site, or the site doesn't track the pollutant
+        abort(404)
+
+    return jsonify({"species": species_code,
+                    "site": site_code,
+                    "window_hours": window,
+                    "times": list(series.index.astype(str)),
+                    "values": list(series.round(2))})
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Pipeline stage timings and counters in the Prometheus text format.
+    """
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/')
@@ -0,0 +1,275 @@
+"""
+Benchmarks for the data loading and map making pipeline, on synthetic data of any size.
+
+Creates a working folder with synthetic data/*_data.csv files and a helper_files/monitoring.json,
+then times each pipeline stage and records its memory use. Results are saved as json,
+so runs on different commits can be compared.
+
+To run:       python benchmark.py --sites 250 --years 5
+To compare:   python benchmark.py --compare benchmark_results/old.json benchmark_results/new.json
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SPECIES_CODES = ["NO2", "O3", "PM10", "SO2", "PM25", "CO"]
+
+# helper files that the map making reads besides the site data
+HELPER_FILES = ["ULEZ_coordinates.csv", "ULEZ_extended_coordinates.csv"]
+
+
+def generate_dataset(target_dir: str, n_sites: int, years: float, seed: int = 0, nan_fraction: float = 0.05):
+    """
+    Creates a synthetic data folder and monitoring.json with the same layout as the real ones.
+    :param target_dir: folder in which data/ and helper_files/ are created
+    :param n_sites: number of monitoring sites
+    :param years: length of the hourly time series per site
+    :param seed: random seed, same seed gives the same data
+    :param nan_fraction: fraction of missing measurements
+    :return:
+    """
+    from mapmaking import get_col_name
+
+    rng = np.random.default_rng(seed)
+
+    data_dir = os.path.join(target_dir, "data")
+    helper_dir = os.path.join(target_dir, "helper_files")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(helper_dir, exist_ok=True)
+
+    for file_name in HELPER_FILES:
+        shutil.copy(os.path.join(REPO_DIR, "helper_files", file_name), helper_dir)
+
+    times = pd.date_range("2000-01-01", periods=int(years * 365.25 * 24), freq=pd.Timedelta(hours=1))
+    daily_cycle = 1 + 0.3 * np.sin(2 * np.pi * times.hour.to_numpy() / 24)
+
+    sites = []
+    for i in range(n_sites):
+        site_code = f"S{i:04d}"
+        # every site tracks NO2, plus a random selection of the other pollutants
+        species = ["NO2"] + [x for x in SPECIES_CODES[1:] if rng.random() < 0.5]
+
+        sites.append({
+            "@SiteCode": site_code,
+            "@SiteName": f"Synthetic - Site {i}",
+            "@Latitude": str(rng.uniform(51.3, 51.7)),
+            "@Longitude": str(rng.uniform(-0.5, 0.3)),
+            "Species": [{"@SpeciesCode": x} for x in species],
+        })
+
+        columns = {}
+        for species_code in species:
+            values = rng.lognormal(mean=3, sigma=0.5, size=len(times)) * daily_cycle
+            values[rng.random(len(times)) < nan_fraction] = np.nan
+            columns[get_col_name(species_code)] = values
+
+        site_df = pd.DataFrame(columns, index=times)
+        site_df.to_csv(os.path.join(data_dir, f"{site_code}_data.csv"), index_label="MeasurementDateGMT",
+                       float_format="%.1f", encoding="utf-8")
+
+    with open(os.path.join(helper_dir, "monitoring.json"), "w") as f:
+        json.dump({"Sites": {"Site": sites}}, f)
+
+
+def measure(func, setup=None, repeat: int = 3, memory: bool = True) -> dict:
+    """
+    Times a function and records its memory use.
+
+    tracemalloc only sees memory allocated by Python and numpy, not memory mapped files, so the growth of the
+    resident memory of the process is recorded as well: the memory still in use once func returns (rss_growth_mb),
+    and how far the run raised the peak of the process (peak_rss_growth_mb, 0 if it stayed below an earlier peak).
+    :param func: function to benchmark, called with the output of setup (if given)
+    :param setup: function that prepares the arguments for func, not included in the measurements
+    :param repeat: number of timed runs
+    :param memory: whether to do an extra run with tracemalloc for the peak memory
+    :return: dictionary with all run times, the best run time and the memory use in MB
+    """
+    def run():
+        args = setup() if setup else ()
+        gc.collect()
+        start = time.perf_counter()
+        func(*args)
+        return time.perf_counter() - start
+
+    times = [run() for _ in range(repeat)]
+    result = {"times_s": times, "best_s": min(times)}
+
+    if memory:  # separate run, because tracing slows down the timed runs
+        args = setup() if setup else ()
+        gc.collect()
+        rss_before, max_rss_before = instrumentation.rss_bytes(), instrumentation.max_rss_bytes()
+        tracemalloc.start()
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_memory_mb"] = peak / 1024 ** 2
+        result["rss_growth_mb"] = (instrumentation.rss_bytes() - rss_before) / 1024 ** 2
+        result["peak_rss_growth_mb"] = (instrumentation.max_rss_bytes() - max_rss_before) / 1024 ** 2
+
+    return result
+
+
+def run_benchmarks(species_code: str, repeat: int = 3, memory: bool = True) -> dict:
+    """
+    Benchmarks all pipeline stages. Has to be run from a folder with data/ and helper_files/.
+    :param species_code: pollutant to make the maps for
+    :param repeat: number of timed runs per stage
+    :param memory: whether to record peak memory use
+    :return: dictionary with the results per stage
+    """
+    import shared_dataset
+    from dataloading import load_from_file
+    from mapmaking import create_heatmap, create_layered_map, pollution_map
+
+    os.makedirs("heatmap_and_dataloading", exist_ok=True)  # create_heatmap saves here
+
+    def clear_dataset_cache():
+        shared_dataset._open_datasets.clear()
+        shutil.rmtree(shared_dataset.DATASET_DIR, ignore_errors=True)
+        return ()
+
+    def unmap_datasets():
+        shared_dataset._open_datasets.clear()  # saved files are kept, so only the memory mapping is measured
+        return ()
+
+    benchmarks = {
+        "load_from_file": (load_from_file, None),
+        "build dataset": (lambda: shared_dataset.open_species_dataset(species_code), clear_dataset_cache),
+        "open dataset": (lambda: shared_dataset.open_species_dataset(species_code), unmap_datasets),
+        "pollution_map": (lambda: pollution_map(species_code), None),
+        "create_heatmap": (lambda data: create_heatmap(data, species_code), lambda: (load_from_file(),)),
+        "create_layered_map": (lambda: create_layered_map(species_code, save=False), None),
+    }
+
+    import app  # the template folder is set to the working directory on import
+    client = app.app.test_client()
+    routes = ["/"] + ([f"/{species_code}_map"] if species_code in app.MAP_SPECIES else [])  # no map route otherwise
+    for route in routes:
+        benchmarks[f"flask {route}"] = (lambda route=route: client.get(route).data, None)
+
+    results = {}
+    for name, (func, setup) in benchmarks.items():
+        print(f"Running: {name}")
+        results[name] = measure(func, setup=setup, repeat=repeat, memory=memory)
+        print(f"    best {results[name]['best_s']:.3f} s", end="")
+        if memory:
+            print(f", peak {results[name]['peak_memory_mb']:.1f} MB, rss {results[name]['rss_growth_mb']:+.1f} MB",
+                  end="")
+        print()
+
+    return results
+
+
+def get_commit() -> str:
+    """
+    Current git commit of the repository, or "unknown" when git is not available.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path: str, new_path: str):
+    """
+    Prints the change in run time, peak memory and resident memory growth per stage between two result files.
+    :param old_path:
+    :param new_path:
+    :return:
+    """
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+
+    print(f"{old['commit']} -> {new['commit']}")
+    for name, new_result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        old_result = old["results"][name]
+        line = f"{name:<25} {old_result['best_s']:8.3f} s -> {new_result['best_s']:8.3f} s " \
+               f"({new_result['best_s'] / old_result['best_s']:.2f}x)"
+        if "peak_memory_mb" in old_result and "peak_memory_mb" in new_result:
+            line += f"    {old_result['peak_memory_mb']:8.1f} MB -> {new_result['peak_memory_mb']:8.1f} MB"
+        if "rss_growth_mb" in old_result and "rss_growth_mb" in new_result:
+            line += f"    rss {old_result['rss_growth_mb']:+8.1f} MB -> {new_result['rss_growth_mb']:+8.1f} MB"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, default=50, help="number of synthetic monitoring sites")
+    parser.add_argument("--years", type=float, default=1, help="years of hourly data per site")
+    parser.add_argument("--species", default="NO2", choices=SPECIES_CODES,
+                        help="pollutant to make the maps for, the flask map route only exists for NO2, PM10 and PM25")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory measurements")
+    parser.add_argument("--workdir", help="folder for the synthetic data, reused if it already has data in it")
+    parser.add_argument("--output", default=os.path.join(REPO_DIR, "benchmark_results"),
+                        help="folder to save the results json in")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ldn_pollution_benchmark_")
+    if not os.path.isdir(os.path.join(workdir, "data")):
+        print(f"Generating {args.sites} sites x {args.years} years of data in {workdir}")
+        generate_dataset(workdir, n_sites=args.sites, years=args.years, seed=args.seed)
+
+    shutil.copy(os.path.join(REPO_DIR, "index.html"), workdir)  # rendered by the "/" route
+
+    import shared_dataset
+
+    # keep everything the benchmark writes in the work folder, the stages clear the dataset folder
+    shared_dataset.DATASET_DIR = os.path.join(workdir, "dataset_cache")
+    instrumentation.METRICS_DIR = os.path.join(workdir, "metrics")
+
+    cwd = os.getcwd()
+    os.chdir(workdir)  # map making reads data/ and helper_files/ relative to the working directory
+    try:
+        results = run_benchmarks(args.species, repeat=args.repeat, memory=not args.no_memory)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    commit = get_commit()
+    output = {
+        "commit": commit,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sites": args.sites,
+        "years": args.years,
+        "species": args.species,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    output_path = os.path.join(args.output, f"{datetime.datetime.now():%Y%m%d_%H%M%S}_{commit}.json")
+    with open(output_path, "w") as f:
+        json.dump(output, f, indent=2)
+
+    print(f"Saved results to {output_path}")
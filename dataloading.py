@@ -9,15 +9,20 @@ import pandas as pd
 import requests
 import urllib
 
+from http_cache import REQUEST_TIMEOUT, cached_get
+from instrumentation import increment, span
 
-def get_info(uri: str, file_format: str = "", save: bool = False, verbose: bool = False):
+
+def get_info(uri: str, file_format: str = "", save: bool = False, verbose: bool = False, use_cache: bool = True):
     """
     Make a GET request to the Open Air API.
+    Responses are cached on disk, see http_cache.py. Set LDN_OFFLINE=1 to only use cached responses.
 
     :param verbose:
     :param uri:
     :param file_format: default = "", produces .xml file upon save
     :param save:
+    :param use_cache: whether to use the on-disk response cache
     :return:
     """
     basic_url = "https://api.erg.ic.ac.uk/AirQuality/"
@@ -29,22 +34,32 @@ def get_info(uri: str, file_format: str = "", save: bool = False, verbose: bool
 
     full_url = urllib.parse.urljoin(basic_url, uri, allow_fragments=True)
 
-    response = requests.get(full_url)
+    if use_cache:
+        status_code, text, from_network = cached_get(full_url)
+    else:
+        response = requests.get(full_url, timeout=REQUEST_TIMEOUT)
+        status_code, text, from_network = response.status_code, response.text, True
+
     if verbose:
-        print(response.text)
+        print(text)
 
-    if response.status_code >= 400:  # request failed
+    if status_code >= 400:  # request failed
+        if from_network:  # the API counters only count actual requests, not cached answers
+            increment("api_requests_failed")
         return False
 
+    if from_network:
+        increment("api_requests_fetched")
+
     if not file_format:
         file_format = "xml"
 
     if save:
         # if the json/xml looks bad, you can use this to format it: https://jsonformatter.curiousconcept.com/#
         with open(f"traffic.{file_format.lower()}", "w", encoding="utf-8") as f:
-            f.write(response.text)
+            f.write(text)
 
-    return response.text
+    return text
 
 
 def get_site_data(uri: str, startdate: str, enddate: str, save: bool = False):
@@ -94,22 +109,26 @@ def get_site_data(uri: str, startdate: str, enddate: str, save: bool = False):
     return site_info
 
 
-def load_from_file(data_path="./data"):
+def load_from_file(data_path="./data", columns: list = None):
     """
     Initialise dataframes from files. Faster than API calls in get_site_data().
     :param data_path: location of data folder
+    :param columns: only read these columns (besides the time), defaults to all columns.
+    Sites without some of the columns are loaded without them
     :return: 
     """
     site_info = {}
     files = os.listdir(data_path)
     codes = [x.split("_")[0] for x in files]
 
-    for code in codes:
-        df = pd.read_csv(f"{data_path}/{code}_data.csv", encoding="utf-8",
-                         index_col=["MeasurementDateGMT"],
-                         parse_dates=["MeasurementDateGMT"])
-        # df.fillna(-1, inplace=True)
-        site_info[code] = df
+    with span("load"):
+        for code in codes:
+            df = pd.read_csv(f"{data_path}/{code}_data.csv", encoding="utf-8",
+                             index_col=["MeasurementDateGMT"],
+                             parse_dates=["MeasurementDateGMT"],
+                             usecols=None if columns is None else lambda x: x == "MeasurementDateGMT" or x in columns)
+            # df.fillna(-1, inplace=True)
+            site_info[code] = df
 
     return site_info
 
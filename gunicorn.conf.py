@@ -0,0 +1,64 @@
+"""
+Gunicorn settings, read automatically when gunicorn is started from this folder (see Procfile).
+
+The app and the map making stack are imported once in the master process, before the workers are forked,
+so the workers share those pages with the master (copy on write) instead of each importing pandas / folium.
+Building the shared site data can take half a minute on a cold start (e.g. after a dyno restart), so that is
+done in a background thread of each worker, which can serve requests in the meantime.
+
+The workers add up their metrics through files in LDN_METRICS_DIR, or in a new temporary folder for this server run
+if it isn't set. Numbers of earlier runs are removed when the server starts.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+preload_app = True
+
+
+def on_starting(server):
+    import instrumentation
+
+    if os.environ.get("LDN_METRICS_DIR"):
+        instrumentation.reset_metrics(os.environ["LDN_METRICS_DIR"])
+    else:
+        instrumentation.reset_metrics(tempfile.mkdtemp(prefix="ldn_metrics_"))
+        server.own_metrics_dir = instrumentation.METRICS_DIR
+
+    # workers are forked from this process and inherit the folder, the variable is for anything imported later
+    os.environ["LDN_METRICS_DIR"] = instrumentation.METRICS_DIR
+
+
+def on_exit(server):
+    if getattr(server, "own_metrics_dir", None):
+        shutil.rmtree(server.own_metrics_dir, ignore_errors=True)
+
+
+def when_ready(server):
+    from app import warm_up
+
+    started = time.perf_counter()
+    try:
+        warm_up()
+    except Exception:  # the workers still import everything themselves when it is needed
+        server.log.exception("Importing the map making stack failed")
+    else:
+        server.log.info("Imported the map making stack in %.1f s", time.perf_counter() - started)
+
+
+def post_worker_init(worker):
+    def open_datasets():
+        from app import open_map_datasets
+
+        started = time.perf_counter()
+        try:
+            open_map_datasets()  # only one worker at a time builds, the others wait for it and reuse the result
+        except Exception:  # maps open the data themselves when they are requested
+            worker.log.exception("Opening the site data failed")
+        else:
+            worker.log.info("Opened the site data in %.1f s", time.perf_counter() - started)
+
+    threading.Thread(target=open_datasets, daemon=True).start()
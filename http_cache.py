@@ -0,0 +1,195 @@
+"""
+Persistent cache for responses from the London Air Quality Network API.
+
+Responses are saved on disk per url, with a time to live that depends on the endpoint. Outdated responses are
+revalidated with a conditional request (ETag / Last-Modified), so unchanged data isn't downloaded again.
+In offline mode (LDN_OFFLINE=1) only cached responses are used and no requests are made at all.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+from instrumentation import increment
+
+CACHE_DIR = os.environ.get("LDN_HTTP_CACHE_DIR", "./http_cache")
+MAX_CACHE_BYTES = int(os.environ.get("LDN_HTTP_CACHE_MAX_BYTES", 500 * 1024 ** 2))
+OFFLINE = os.environ.get("LDN_OFFLINE", "0") not in ("", "0")
+REQUEST_TIMEOUT = float(os.environ.get("LDN_HTTP_TIMEOUT", 30))  # seconds, for connecting and for each read
+
+# time to live in seconds per endpoint, the first endpoint that is part of the url is used
+ENDPOINT_TTLS = [
+    ("Information/Species", 30 * 24 * 3600),  # rarely changing metadata
+    ("Information/MonitoringSiteSpecies", 7 * 24 * 3600),
+    ("Information/MonitoringSites", 7 * 24 * 3600),
+    ("Information/", 7 * 24 * 3600),
+    ("Data/", 24 * 3600),
+]
+DEFAULT_TTL = 3600
+
+
+def get_ttl(url: str) -> int:
+    """
+    Time to live of a cached response for the url.
+    :param url:
+    :return: seconds
+    """
+    for endpoint, ttl in ENDPOINT_TTLS:
+        if endpoint in url:
+            return ttl
+    return DEFAULT_TTL
+
+
+def _paths(url: str, cache_dir: str) -> tuple:
+    """
+    Files for the response body and its metadata.
+    """
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{key}.body"), os.path.join(cache_dir, f"{key}.json")
+
+
+def _read_entry(url: str, cache_dir: str):
+    """
+    Cached metadata and body for the url, or None if it isn't cached.
+    """
+    body_path, meta_path = _paths(url, cache_dir)
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "r", encoding="utf-8") as f:
+            body = f.read()
+    except (OSError, ValueError):  # not cached, or partially evicted
+        return None
+
+    return meta, body
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _write_entry(url: str, meta: dict, body: str, cache_dir: str):
+    body_path, meta_path = _paths(url, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    _write_atomic(body_path, body)
+    _write_atomic(meta_path, json.dumps(meta))  # metadata last, an entry is only valid once it exists
+
+
+def _touch(url: str, cache_dir: str):
+    """
+    Marks the entry as recently used, for least recently used eviction.
+    """
+    try:
+        os.utime(_paths(url, cache_dir)[1])
+    except OSError:
+        pass
+
+
+def evict(cache_dir: str = None, max_bytes: int = None):
+    """
+    Removes the least recently used responses until the cache is smaller than max_bytes.
+    :param cache_dir: defaults to CACHE_DIR
+    :param max_bytes: defaults to MAX_CACHE_BYTES
+    :return:
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []  # (last used, size, body path, meta path)
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith(".json"):
+            continue
+        body_path = entry.path[:-len(".json")] + ".body"
+        size = os.path.getsize(body_path) if os.path.isfile(body_path) else 0
+        entries.append((entry.stat().st_mtime, size, body_path, entry.path))
+
+    total = sum(x[1] for x in entries)
+    for _, size, body_path, meta_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for path in (meta_path, body_path):
+            if os.path.isfile(path):
+                os.remove(path)
+        total -= size
+
+
+def cached_get(url: str, ttl: int = None, offline: bool = None, cache_dir: str = None) -> tuple:
+    """
+    GET request that is answered from the on-disk cache when possible.
+
+    - fresh cached response: returned without a request
+    - outdated cached response: revalidated with a conditional request, downloaded again only if it changed
+    - API unreachable or server error (status >= 500): the outdated cached response is returned, if there is one
+    - offline: the cached response is returned however old it is, status 504 if there is none
+    Failed responses (status >= 400) are not cached.
+    :param url:
+    :param ttl: time to live in seconds, defaults to the value for the endpoint in ENDPOINT_TTLS
+    :param offline: only use the cache, defaults to OFFLINE
+    :param cache_dir: defaults to CACHE_DIR
+    :return: status code, response text, and whether the response came from the API (False if it came from the cache)
+    """
+    ttl = get_ttl(url) if ttl is None else ttl
+    offline = OFFLINE if offline is None else offline
+    cache_dir = cache_dir or CACHE_DIR
+
+    cached = _read_entry(url, cache_dir)
+
+    if cached is not None:
+        meta, body = cached
+        if offline or time.time() - meta["fetched_at"] < ttl:
+            increment("http_cache_hits")
+            _touch(url, cache_dir)
+            return meta["status_code"], body, False
+
+    if offline:
+        increment("http_cache_misses")
+        return 504, "", False  # same as a HTTP "only-if-cached" request that isn't cached
+
+    headers = {}
+    if cached is not None:
+        if cached[0].get("etag"):
+            headers["If-None-Match"] = cached[0]["etag"]
+        if cached[0].get("last_modified"):
+            headers["If-Modified-Since"] = cached[0]["last_modified"]
+
+    try:
+        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException:
+        if cached is None:
+            raise
+        increment("http_cache_stale_hits")  # API unreachable, outdated data is better than none
+        return cached[0]["status_code"], cached[1], False
+
+    if response.status_code >= 500 and cached is not None:  # API is having problems, same as unreachable
+        increment("http_cache_stale_hits")
+        return cached[0]["status_code"], cached[1], False
+
+    if response.status_code == 304 and cached is not None:  # not modified, keep using the cached body
+        increment("http_cache_revalidated")
+        meta, body = cached
+        meta["fetched_at"] = time.time()
+        _write_atomic(_paths(url, cache_dir)[1], json.dumps(meta))
+        return meta["status_code"], body, True
+
+    increment("http_cache_misses")
+
+    if response.status_code < 400:
+        meta = {"url": url,
+                "status_code": response.status_code,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": time.time()}
+        _write_entry(url, meta, response.text, cache_dir)
+        evict(cache_dir)
+
+    return response.status_code, response.text, True
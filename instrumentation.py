@@ -0,0 +1,279 @@
+"""
+Lightweight instrumentation of the map making pipeline.
+
+Keeps track of time and memory per pipeline stage (e.g. load, open dataset, aggregate, feature build, render)
+and of simple counters, such as API requests and map cache hits. Every process keeps its own numbers in memory.
+When METRICS_DIR is set (LDN_METRICS_DIR, or a fresh folder per server run by gunicorn.conf.py), every process also
+writes them to a json file there, so the metrics of all gunicorn workers can be added up in the Prometheus text
+format, whichever worker answers the request. A single map build can also be dumped as a json trace.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:  # not available on Windows, memory is then not recorded
+    import resource
+except ImportError:
+    resource = None
+
+_lock = threading.Lock()
+_local = threading.local()  # spans of the trace for the current thread, if one is being collected
+
+METRICS_DIR = os.environ.get("LDN_METRICS_DIR") or None  # None = only keep the numbers of this process
+
+_process_key = f"{os.getpid()}_{uuid.uuid4().hex}"  # file name in METRICS_DIR, unique even if a pid is reused
+
+_counters = defaultdict(int)  # key = counter name, value = count
+_stages = defaultdict(lambda: {"runs": 0, "seconds": 0.0, "max_rss_growth_bytes": 0})  # key = stage name
+
+COUNTER_HELP = {
+    "api_requests_fetched": "Successful requests to the London Air Quality Network API, cache hits not included.",
+    "api_requests_failed": "Failed requests to the London Air Quality Network API, cache hits not included.",
+    "http_cache_hits": "API requests answered from the on-disk response cache.",
+    "http_cache_misses": "API requests that were not cached, or not cached in offline mode.",
+    "http_cache_revalidated": "Outdated cached API responses that turned out to be unchanged.",
+    "http_cache_stale_hits": "Outdated cached API responses used because the API was unreachable or failing.",
+    "map_cache_hits": "Map requests served from a prebuilt html file.",
+    "map_cache_misses": "Map requests for which the map had to be built.",
+}
+
+
+def _reset_after_fork():
+    """
+    Forked processes (e.g. workers of a preloaded gunicorn app) start counting from zero in their own file,
+    the numbers of the parent process are already in the file of the parent.
+    """
+    global _process_key
+    _process_key = f"{os.getpid()}_{uuid.uuid4().hex}"
+    _counters.clear()
+    _stages.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def max_rss_bytes() -> int:
+    """
+    Highest resident memory of this process so far, 0 if unknown.
+    """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # in kilobytes on Linux
+
+
+def rss_bytes() -> int:
+    """
+    Current resident memory of this process, 0 if unknown (only available on Linux).
+    Unlike the peak memory, this also shows growth of a stage that stays below an earlier peak.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def reset_metrics(metrics_dir: str = None):
+    """
+    Removes the saved numbers of all processes, e.g. of earlier server runs. Use when starting a server.
+    :param metrics_dir: folder to save the numbers in from now on, defaults to the current METRICS_DIR
+    :return:
+    """
+    global METRICS_DIR
+    if metrics_dir is not None:
+        METRICS_DIR = metrics_dir
+
+    if METRICS_DIR is None or not os.path.isdir(METRICS_DIR):
+        return
+
+    for entry in os.scandir(METRICS_DIR):
+        if entry.name.endswith((".json", ".tmp")):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def _save():
+    """
+    Writes the numbers of this process to its file in METRICS_DIR, if set. Call while holding _lock.
+    """
+    if METRICS_DIR is None:
+        return
+
+    path = os.path.join(METRICS_DIR, f"{_process_key}.json")
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump({"counters": _counters, "stages": _stages, "rss_bytes": rss_bytes(),
+                       "max_rss_bytes": max_rss_bytes()}, f)
+        os.replace(tmp_path, path)
+    except OSError:  # metrics are best effort, never fail a request because of them
+        pass
+
+
+def _load_all() -> list:
+    """
+    Saved numbers of all processes, with the in-memory numbers for this process.
+    """
+    with _lock:
+        processes = {_process_key: {"counters": dict(_counters),
+                                    "stages": {name: dict(stats) for name, stats in _stages.items()},
+                                    "rss_bytes": rss_bytes(),
+                                    "max_rss_bytes": max_rss_bytes()}}
+
+    if METRICS_DIR is not None and os.path.isdir(METRICS_DIR):
+        for entry in os.scandir(METRICS_DIR):
+            key, ext = os.path.splitext(entry.name)
+            if ext != ".json" or not key.split("_")[0].isdigit() or key in processes:
+                continue
+            try:
+                with open(entry.path, "r") as f:
+                    processes[key] = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    for key, numbers in processes.items():
+        numbers["alive"] = _is_alive(int(key.split("_")[0]))
+
+    return list(processes.values())
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # exists, but belongs to someone else
+        return True
+    return True
+
+
+def increment(counter: str, amount: int = 1):
+    """
+    Increase a counter.
+    :param counter: name of the counter, e.g. "api_requests_fetched"
+    :param amount:
+    :return:
+    """
+    with _lock:
+        _counters[counter] += amount
+        _save()
+
+
+@contextmanager
+def span(stage: str):
+    """
+    Records the time spent and the growth of the resident memory in a pipeline stage.
+
+    Use as:
+        with span("load"):
+            ...
+    :param stage: name of the stage, e.g. load (csv files), open dataset, aggregate, quantile, feature build, render
+    :return:
+    """
+    spans = getattr(_local, "spans", None)
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        rss_growth = rss_bytes() - rss_before
+        _local.depth = depth
+
+        with _lock:
+            stats = _stages[stage]
+            stats["runs"] += 1
+            stats["seconds"] += seconds
+            stats["max_rss_growth_bytes"] = max(stats["max_rss_growth_bytes"], rss_growth)
+            _save()
+
+        if spans is not None:
+            spans.append({"stage": stage, "depth": depth, "start": start - _local.trace_start,
+                          "seconds": seconds, "rss_growth_bytes": rss_growth})
+
+
+@contextmanager
+def trace(path: str = None):
+    """
+    Collects all spans in the current thread, e.g. for a single map build, and optionally dumps them as json.
+    :param path: file to write the trace to, nothing is written if None
+    :return: list of spans, filled as the stages finish
+    """
+    _local.spans = []
+    _local.trace_start = time.perf_counter()
+    try:
+        yield _local.spans
+    finally:
+        spans = _local.spans
+        _local.spans = None
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path, "w") as f:
+                    json.dump({"spans": spans, "rss_bytes": rss_bytes(), "max_rss_bytes": max_rss_bytes()}, f,
+                              indent=2)
+            except OSError:  # traces are best effort, never fail a request because of them
+                pass
+
+
+def render_metrics() -> str:
+    """
+    All counters and stage statistics in the Prometheus text exposition format, added up over all processes.
+    :return:
+    """
+    processes = _load_all()
+
+    counters = defaultdict(int)
+    stages = defaultdict(lambda: {"runs": 0, "seconds": 0.0, "max_rss_growth_bytes": 0})
+    for numbers in processes:
+        for counter, count in numbers["counters"].items():
+            counters[counter] += count
+        for name, stats in numbers["stages"].items():
+            stages[name]["runs"] += stats["runs"]
+            stages[name]["seconds"] += stats["seconds"]
+            stages[name]["max_rss_growth_bytes"] = max(stages[name]["max_rss_growth_bytes"],
+                                                       stats["max_rss_growth_bytes"])
+
+    lines = []
+    for counter in sorted(set(COUNTER_HELP) | set(counters)):
+        metric = f"ldn_{counter}_total"
+        lines.append(f"# HELP {metric} {COUNTER_HELP.get(counter, counter.replace('_', ' '))}")
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {counters.get(counter, 0)}")
+
+    stage_metrics = [("ldn_stage_runs_total", "counter", "Number of times a pipeline stage ran.", "runs"),
+                     ("ldn_stage_seconds_total", "counter", "Time spent per pipeline stage.", "seconds"),
+                     ("ldn_stage_max_rss_growth_bytes", "gauge",
+                      "Largest increase of the resident memory during a pipeline stage.", "max_rss_growth_bytes")]
+    for metric, metric_type, help_text, key in stage_metrics:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for stage in sorted(stages):
+            lines.append(f'{metric}{{stage="{stage}"}} {stages[stage][key]}')
+
+    # memory is only meaningful for processes that are still running
+    alive = [x for x in processes if x["alive"]]
+    lines.append("# HELP ldn_processes Number of running processes reporting metrics.")
+    lines.append("# TYPE ldn_processes gauge")
+    lines.append(f"ldn_processes {len(alive)}")
+    lines.append("# HELP ldn_process_rss_bytes Resident memory of all running processes, as of their last update.")
+    lines.append("# TYPE ldn_process_rss_bytes gauge")
+    lines.append(f"ldn_process_rss_bytes {sum(x.get('rss_bytes', 0) for x in alive)}")
+    lines.append("# HELP ldn_process_max_rss_bytes Highest peak resident memory of a single running process.")
+    lines.append("# TYPE ldn_process_max_rss_bytes gauge")
+    lines.append(f"ldn_process_max_rss_bytes {max([x.get('max_rss_bytes', 0) for x in alive] + [0])}")
+
+    return "\n".join(lines) + "\n"
@@ -9,11 +9,14 @@ import itertools
 import matplotlib
 import numpy as np
 import pandas as pd
-from folium.plugins import HeatMapWithTime
 from matplotlib import pyplot as plt
 
+from analysis import ROLLING_WINDOWS, matrix_statistics, rolling_mean, site_statistics
 from dataloading import load_from_file
-from timestamped_geo_json import TimestampedGeoJson
+from instrumentation import span
+from packed_heat_map import PackedHeatMapWithTime
+from shared_dataset import open_species_dataset
+from timestamped_geo_json import TimestampedGeoJson, GeoJsonFeatureWriter
 import folium
 
 
@@ -54,56 +57,40 @@ def create_heatmap(data_dict: dict, species_code: str):
 
     available_sites = set([x.split("_")[0] for x in os.listdir("data")])
 
-    # group dataframes for the possible sites by week
-    for site_code in possible_sites:
-        if site_code in available_sites:
-            data_dict[site_code] = data_dict[site_code].groupby(data_dict[site_code].index.to_period("W")).mean()
-
-    # get upper and lower values, so outliers are excluded
-    all_val = [list(data_dict[x][species_col]) for x in possible_sites if x in available_sites and
-               species_col in data_dict[x].columns]  # all species values for all sites in one list
-    all_val = list(itertools.chain.from_iterable(all_val))  # flatten
-    all_val = [x for x in all_val if not np.isnan(x)]  # remove nan
-
-    quantile_upper = np.quantile(all_val, 0.75)
-    quantile_lower = np.quantile(all_val, 0.25)
-    iqr = quantile_upper - quantile_lower
-    # max possible values is 3rd quantile + 1.5 * inter-quartile range. Scale can be adjusted if necessary
-    max_val = quantile_upper + iqr * 1.5
-    min_val = quantile_lower - iqr * 1.5
-
-    # putting data in correct format for HeatmapWithTime
-    first_df = data_dict[possible_sites[0]]
-    timeseries_list = list(first_df.index)
-    data_list = []
-    for i, time in enumerate(timeseries_list):
-        shortlist = []
+    with span("aggregate"):
+        # group dataframes for the possible sites by week
         for site_code in possible_sites:
-
-            # exclude irrelevant sites or improper column names
-            if site_code not in available_sites or species_col not in data_dict[site_code].columns:
-                continue
-
-            current_df = data_dict[site_code]
-            current_species_data = current_df.loc[time, species_col]
-
-            # exclude nans and outliers
-            if np.isnan(current_species_data) or current_species_data > max_val or current_species_data < min_val:
-                continue
-
-            (lat, long), _ = lat_long_dict[site_code]
-            merged_lists = [lat, long, current_species_data]
-            # merged_lists = tuple([round(lat, 3), round(long, 3)])
-            shortlist.append(merged_lists)
-        data_list.append(shortlist)
-        # progress update
-        if i % 100 == 0:
-            print(f"processed {i}/{timeseries_list.__len__()} dates")
-
-    # normalising values
-    for timepoint in data_list:
-        for location in timepoint:
-            location[2] = (location[2] - min_val) / (max_val - min_val)
+            if site_code in available_sites:
+                data_dict[site_code] = data_dict[site_code].groupby(data_dict[site_code].index.to_period("W")).mean()
+
+    with span("quantile"):
+        # get upper and lower values, so outliers are excluded
+        all_val = [list(data_dict[x][species_col]) for x in possible_sites if x in available_sites and
+                   species_col in data_dict[x].columns]  # all species values for all sites in one list
+        all_val = list(itertools.chain.from_iterable(all_val))  # flatten
+        all_val = [x for x in all_val if not np.isnan(x)]  # remove nan
+
+        quantile_upper = np.quantile(all_val, 0.75)
+        quantile_lower = np.quantile(all_val, 0.25)
+        iqr = quantile_upper - quantile_lower
+        # max possible values is 3rd quantile + 1.5 * inter-quartile range. Scale can be adjusted if necessary
+        max_val = quantile_upper + iqr * 1.5
+        min_val = quantile_lower - iqr * 1.5
+
+    with span("feature build"):
+        # putting data in correct format for PackedHeatMapWithTime: one row per time, one column per site
+        timeseries_index = data_dict[possible_sites[0]].index
+        heatmap_sites = [x for x in possible_sites if x in available_sites and species_col in data_dict[x].columns]
+
+        coordinates = [lat_long_dict[site_code][0] for site_code in heatmap_sites]
+        frames = np.column_stack([data_dict[site_code][species_col].reindex(timeseries_index).to_numpy()
+                                  for site_code in heatmap_sites])
+
+        # exclude outliers (nans are left out of the frames by the layer)
+        frames[(frames > max_val) | (frames < min_val)] = np.nan
+
+        # normalising values
+        frames = (frames - min_val) / (max_val - min_val)
 
     ldn_coords = [51.509865, -0.118092]
 
@@ -111,19 +98,21 @@ def create_heatmap(data_dict: dict, species_code: str):
                              tiles="CartoDB dark_matter"
                              )
 
-    hmap_layer = HeatMapWithTime(data_list,
-                                 index=list(data_dict[possible_sites[0]].index.astype(str)),
-                                 use_local_extrema=False, name="Heat Map",
-                                 min_speed=5,
-                                 max_speed=50,
-                                 speed_step=1,
-                                 radius=20, display_index=True, overlay=True, control=True)
+    with span("serialize"):
+        hmap_layer = PackedHeatMapWithTime(coordinates, frames,
+                                           index=list(timeseries_index.astype(str)),
+                                           use_local_extrema=False, name="Heat Map",
+                                           min_speed=5,
+                                           max_speed=50,
+                                           speed_step=1,
+                                           radius=20, display_index=True, overlay=True, control=True)
 
     folium_hmap.add_child(hmap_layer)
     # folium_hmap.add_child(folium.FeatureGroup(name='Heat Map').add_child(hmap_layer))
     folium.LayerControl().add_to(folium_hmap)
 
-    folium_hmap.save("heatmap_and_dataloading/hmap_london_positron.html")
+    with span("render"):
+        folium_hmap.save("heatmap_and_dataloading/hmap_london_positron.html")
 
 def get_sites_by_pollutant(species_code: str) -> list:
     """
@@ -286,114 +275,282 @@ def extended_ulez_line():
     return feature_group
 
 
-def pollution_map(species_code: str, create_map: bool = False) -> TimestampedGeoJson:
+def pollution_map(species_code: str, create_map: bool = False, resolution: str = "W",
+                  delta_encode: bool = False, n_bins: int = 16) -> TimestampedGeoJson:
     """
     Creates an interactive layer with monitoring sites and pollution levels indicated by site colour.
     :param species_code:
     :param create_map: determines whether to save the layer as a map in itself
+    :param resolution: "W" for weekly or "D" for daily means
+    :param delta_encode: quantize values into colour bins, and only add a feature when the bin of a site changes.
+    Each feature is then shown until the next change, which keeps the html and the markers per frame to a minimum
+    :param n_bins: number of colour bins when delta encoding
     :return:
     """
-    sites_dict = load_from_file()  # key = site code, value = pd.Dataframe with monitoring info
+    # weekly or daily means of all sites that track the pollutant, memory mapped and shared with other processes
+    dataset = open_species_dataset(species_code)
+    period_vals, period_strs = (dataset.weekly, dataset.weeks) if resolution == "W" else (dataset.daily, dataset.days)
+    period_strs = np.array(period_strs)
 
     species_col = get_col_name(species_code)  # column name in csv for the species code
 
     lat_long_dict = get_lat_long_dict()  # key = site code, value = lat, long, site name
 
-    relevant_sites = get_sites_by_pollutant(species_code)  # list of sites that track the selected pollutant
+    # GEOJSON features are serialized as they are created
+    writer = GeoJsonFeatureWriter()
 
-    available_sites = set([x.split("_")[0] for x in os.listdir("./data")])
+    colourmap = plt.get_cmap('plasma')  # used when colouring sites based on pollutant level
 
-    useful_sites = set(relevant_sites).intersection(available_sites)
+    with span("quantile"):
+        # get upper and lower values for all data, so outliers are excluded
+        all_val = period_vals[~np.isnan(period_vals)]  # all species values for all sites, without nan
 
-    # group dataframes for the possible sites by week
-    for site_code in useful_sites:
-        sites_dict[site_code] = sites_dict[site_code].groupby(sites_dict[site_code].index.to_period("W")).mean()
+        quantile_upper = np.quantile(all_val, 0.75)
+        quantile_lower = np.quantile(all_val, 0.25)
+        iqr = quantile_upper - quantile_lower
+        # max possible values is 3rd quantile + 1.5 * inter-quartile range. Scale can be adjusted if necessary
+        max_val = quantile_upper + iqr * 1.5
+        min_val = quantile_lower - iqr * 1.5
 
-    # creating GEOJSON feature objects
-    features = []
+    with span("feature build"):
+        for site_key, species_vals in zip(dataset.site_codes, period_vals):
+            (lat, long), site_name = lat_long_dict[site_key]
 
-    colourmap = plt.get_cmap('plasma')  # used when colouring sites based on pollutant level
+            # exclude nans and outliers
+            valid = ~np.isnan(species_vals) & (species_vals <= max_val) & (species_vals >= min_val)
+
+            if delta_encode:
+                starts, ends, bins = bin_changes(species_vals, valid, min_val, max_val, n_bins)
+                bin_width = (max_val - min_val) / n_bins
+
+                # colour of the middle of the bin, text shows on site click
+                colours = [matplotlib.colors.to_hex(colourmap((b + 0.5) / n_bins), keep_alpha=False) for b in bins]
+                properties = (create_feature_properties(
+                    date=period_strs[start], end_date=period_strs[end], color=colour,
+                    popuptext=f"{site_name}<br />{round(min_val + b * bin_width, 2)} - "
+                              f"{round(min_val + (b + 1) * bin_width, 2)} {species_col}"
+                              f"<br />since {period_strs[start]}")
+                    for start, end, b, colour in zip(starts, ends, bins, colours))
+                n_features = len(starts)
+            else:
+                species_vals = species_vals[valid]
+                date_strs = period_strs[valid]
+
+                # normalise registered values and picking corresponding colours
+                colour_vals = colourmap((species_vals - min_val) / (max_val - min_val))
+                colours = [matplotlib.colors.to_hex(c, keep_alpha=False) for c in colour_vals]
+
+                # make data json feature properties, text shows on site click
+                properties = (create_feature_properties(
+                    date=date_str, color=colour, popuptext=f"{site_name}<br />{round(species_val, 2)} {species_col}")
+                    for species_val, date_str, colour in zip(species_vals, date_strs, colours))
+                n_features = len(species_vals)
+
+            writer.write_points(np.full(n_features, lat), np.full(n_features, long), properties)
 
-    # get upper and lower values for all data, so outliers are excluded
-    all_val = [list(sites_dict[x][species_col]) for x in useful_sites if
-               species_col in sites_dict[x].columns]  # all species values for all sites in one list
-    all_val = list(itertools.chain.from_iterable(all_val))  # flatten
-    all_val = [x for x in all_val if not np.isnan(x)]  # remove nan
+    # map making
+    with span("serialize"):
+        timejson = TimestampedGeoJson(
+            writer,
+            period='P1W' if resolution == "W" else 'P1D',
+            # delta encoded features are only shown during their [start, end] times, not after
+            duration='PT1M' if delta_encode else None,
+            update_time_dimension_mode='extremes' if delta_encode else None,
+            add_last_point=True,
+            auto_play=False,
+            loop=False,
+            min_speed=5,
+            max_speed=50,
+            loop_button=True,
+            date_options='YYYY-MM-DD',
+            time_slider_drag_update=True,
+            speed_step=1,
+            name=f"Time Map for {species_code}",
+            overlay=True,
+            control=True
+        )
 
-    quantile_upper = np.quantile(all_val, 0.75)
-    quantile_lower = np.quantile(all_val, 0.25)
-    iqr = quantile_upper - quantile_lower
-    # max possible values is 3rd quantile + 1.5 * inter-quartile range. Scale can be adjusted if necessary
-    max_val = quantile_upper + iqr * 1.5
-    min_val = quantile_lower - iqr * 1.5
+    if create_map:
+        m = folium.Map(location=[51.509865, -0.118092], tiles="Stamen Toner", zoom_start=11)
 
-    for site_key in list(useful_sites):
-        (lat, long), site_name = lat_long_dict[site_key]
+        timejson.add_to(m)
 
-        if species_col not in sites_dict[site_key].columns:  # pollutant column not present, skip
-            continue
+        folium.LayerControl().add_to(m)
 
-        df = sites_dict[site_key]
-        for _, row in df.iterrows():
-            species_val = row.loc[species_col]
+        with span("render"):
+            m.save("timemap_test.html")
 
-            if np.isnan(species_val):  # exclude nans
-                continue
+    return timejson
 
-            # exclude outliers
-            if species_val > max_val or species_val < min_val:
-                continue
+def bin_changes(values: np.ndarray, valid: np.ndarray, min_val: float, max_val: float, n_bins: int) -> tuple:
+    """
+    Quantizes values into equal width bins and finds the periods in which the bin stays the same.
+    Invalid values don't end a period, the last valid bin is carried forward until the next valid value.
+    :param values: value per time period of a single site
+    :param valid: boolean mask of the values to use
+    :param min_val: lower edge of the first bin
+    :param max_val: upper edge of the last bin
+    :param n_bins:
+    :return: start index, end index (inclusive) and bin of every period
+    """
+    valid_idx = np.flatnonzero(valid)
+    if not len(valid_idx):
+        return valid_idx, valid_idx, valid_idx
 
-            # normalise registered value and picking corresponding colour
-            colour_val = (species_val - min_val) / (max_val - min_val)
-            colour = matplotlib.colors.to_hex(colourmap(colour_val), keep_alpha=False)
+    bins = np.clip(((values[valid_idx] - min_val) / (max_val - min_val) * n_bins).astype(int), 0, n_bins - 1)
 
-            date_str = row.name.start_time.__str__()[:10]  # exclude h:m:s info
-            text = f"{site_name}<br />{round(species_val, 2)} {species_col}"  # shows on site click
+    changed = np.r_[True, bins[1:] != bins[:-1]]
+    starts = valid_idx[changed]
+    ends = np.r_[starts[1:] - 1, valid_idx[-1]]  # up to the next change, or the last valid value
 
-            # make data a json feature
-            feature = create_feature_json(lat=lat, long=long, date=date_str, color=colour,
-                                          popuptext=text)
-            features.append(feature)
+    return starts, ends, bins[changed]
 
-    # map making
-    timejson = TimestampedGeoJson(
-        {'type': 'FeatureCollection',
-         'features': features},
-        period='P1W',
-        add_last_point=True,
-        auto_play=False,
-        loop=False,
-        min_speed=5,
-        max_speed=50,
-        loop_button=True,
-        date_options='YYYY-MM-DD',
-        time_slider_drag_update=True,
-        speed_step=1,
-        name=f"Time Map for {species_code}",
-        overlay=True,
-        control=True
-    )
 
-    if create_map:
-        m = folium.Map(location=[51.509865, -0.118092], tiles="Stamen Toner", zoom_start=11)
+def exceedance_statistics(species_code: str, sites_dict: dict = None) -> dict:
+    """
+    Exceedance counts and rolling means for all sites that track the pollutant.
+    :param species_code: options are NO2, O3, PM10, SO2, PM25, CO
+    :param sites_dict: site data as returned by load_from_file(), the shared dataset is used if not given
+    :return: dictionary with the limits used and statistics per site code, see analysis.matrix_statistics()
+    """
+    if sites_dict is None:
+        dataset = open_species_dataset(species_code)
+        with span("analysis"):
+            return matrix_statistics(dataset.site_codes, dataset.times, dataset.hourly, species_code)
 
-        timejson.add_to(m)
+    relevant_sites = get_sites_by_pollutant(species_code)
 
-        folium.LayerControl().add_to(m)
+    with span("analysis"):
+        return site_statistics(sites_dict, species_code, get_col_name(species_code), site_codes=relevant_sites)
 
-        m.save("timemap_test.html")
 
-    return timejson
+def rolling_mean_series(species_code: str, site_code: str, window: int = 24) -> pd.Series:
+    """
+    Rolling mean over time of a pollutant for a single site.
+    :param species_code: options are NO2, O3, PM10, SO2, PM25, CO
+    :param site_code:
+    :param window: averaging window in hours
+    :return: series with the rolling mean per hour, without the hours that have too little data.
+    None if the site is unknown or doesn't track the pollutant
+    """
+    dataset = open_species_dataset(species_code)
+
+    if site_code not in dataset.site_codes:
+        return None
+
+    site_row = dataset.hourly[dataset.site_codes.index(site_code)]
 
-def create_layered_map(species_code: str, save: bool = True) -> folium.Map:
+    return pd.Series(rolling_mean(site_row[np.newaxis, :], window)[0], index=dataset.times).dropna()
+
+
+def exceedance_layer(species_code: str, stats: dict = None) -> folium.FeatureGroup:
+    """
+    Marks all sites tracking the pollutant, coloured by how often the first limit for the pollutant was exceeded.
+    :param species_code:
+    :param stats: output of exceedance_statistics(), calculated if not given
+    :return:
+    """
+    if stats is None:
+        stats = exceedance_statistics(species_code)
+
+    feature_group = folium.FeatureGroup('Limit exceedances', show=False)
+
+    if not stats["limits"]:  # no limits known for this pollutant
+        return feature_group
+
+    limit_name = stats["limits"][0]["name"]
+    max_count = max([x["exceedances"][limit_name] for x in stats["sites"].values()] + [1])
+
+    return _site_stats_layer(feature_group, stats, colour_val=lambda x: x["exceedances"][limit_name] / max_count)
+
+
+def rolling_mean_layer(species_code: str, window: int = 24, stats: dict = None) -> folium.FeatureGroup:
+    """
+    Marks all sites tracking the pollutant, coloured by their highest rolling mean.
+    :param species_code:
+    :param window: averaging window in hours, one of analysis.ROLLING_WINDOWS
+    :param stats: output of exceedance_statistics(), calculated if not given
+    :return:
+    """
+    if stats is None:
+        stats = exceedance_statistics(species_code)
+
+    feature_group = folium.FeatureGroup(f'Highest {window}-hour mean', show=False)
+
+    max_means = [x[f"max_{window}h_mean"] for x in stats["sites"].values() if x[f"max_{window}h_mean"] is not None]
+    if not max_means:
+        return feature_group
+
+    min_val, max_val = min(max_means), max(max_means)
+
+    def colour_val(site_stats):
+        if site_stats[f"max_{window}h_mean"] is None:
+            return None
+        return (site_stats[f"max_{window}h_mean"] - min_val) / ((max_val - min_val) or 1)
+
+    return _site_stats_layer(feature_group, stats, colour_val=colour_val)
+
+
+def _site_stats_layer(feature_group: folium.FeatureGroup, stats: dict, colour_val) -> folium.FeatureGroup:
+    """
+    Adds a circle per site to the feature group, with all statistics for the site in the popup.
+    :param feature_group:
+    :param stats: output of exceedance_statistics()
+    :param colour_val: function from the statistics of a site to a value between 0 and 1, or None to skip the site
+    :return: the feature group
+    """
+    lat_long_dict = get_lat_long_dict()
+
+    colourmap = plt.get_cmap('plasma')
+
+    for site_code, site_stats in stats["sites"].items():
+        if site_code not in lat_long_dict:  # exclude sites without coords
+            continue
+
+        if not site_stats["hours_measured"]:  # skip sites that don't have data in the time period
+            continue
+
+        val = colour_val(site_stats)
+        if val is None:
+            continue
+
+        (lat, long), site_name = lat_long_dict[site_code]
+        colour = matplotlib.colors.to_hex(colourmap(val), keep_alpha=False)
+
+        lines = [f"<b>{site_name}</b>"]
+        lines += [f"{x['name']} exceedances: {site_stats['exceedances'][x['name']]} {x['counted_in']}"
+                  for x in stats["limits"]]
+        lines += [f"{key.replace('_', ' ')}: {value}" for key, value in site_stats.items()
+                  if key.endswith("h_mean") and value is not None]
+
+        folium.CircleMarker(
+            location=(lat, long),
+            radius=10,
+            popup="<br />".join(lines),
+            color=colour,
+            fill=True,
+            stroke=False,
+            weight=1,
+            fill_color=colour,
+            fill_opacity=0.8
+        ).add_to(feature_group)
+
+    return feature_group
+
+
+def create_layered_map(species_code: str, save: bool = True, analysis_layers: bool = False, resolution: str = "W",
+                       delta_encode: bool = False) -> folium.Map:
     """
     Creates the full folium map with layers:
     - sites layer: all relevant sites in a grey colour
     - time layer: shows pollution over time per site using colour
     - ulez area layer: displays the ULEZ on the map
+    - exceedance and rolling mean layers (optional): sites coloured by limit exceedances and highest rolling means
     :param species_code:
     :param save: whether to save the generated map
+    :param analysis_layers: whether to add the exceedance and rolling mean layers
+    :param resolution: "W" for weekly or "D" for daily means in the time layer
+    :param delta_encode: only add time layer features when the colour of a site changes, see pollution_map()
     :return: folium.Map object with all layers
     """
     m = folium.Map(location=[51.509865, -0.118092], tiles="Stamen Toner", zoom_start=11)
@@ -410,13 +567,20 @@ def create_layered_map(species_code: str, save: bool = True) -> folium.Map:
     # sites_layer.add_to(m)
 
     # layer with pollution over time
-    time_layer = pollution_map(species_code=species_code)
+    time_layer = pollution_map(species_code=species_code, resolution=resolution, delta_encode=delta_encode)
     time_layer.add_to(m)
 
+    if analysis_layers:
+        stats = exceedance_statistics(species_code)
+        exceedance_layer(species_code, stats=stats).add_to(m)
+        for window in ROLLING_WINDOWS:
+            rolling_mean_layer(species_code, window=window, stats=stats).add_to(m)
+
     folium.LayerControl().add_to(m)
 
     if save:
-        m.save(f"ULEZ_map_{species_code}.html")
+        with span("render"):
+            m.save(f"ULEZ_map_{species_code}.html")
 
     return m
 
@@ -437,20 +601,34 @@ def create_feature_json(lat: float, long: float, date: str, color: str, popuptex
             'type': 'Point',
             'coordinates': [long, lat]
         },
-        'properties': {
-            'time': date,
-            # 'style': {'color': color},
-            'icon': 'circle',
-            'popup': popuptext,
-            'iconstyle': {
-                'fillColor': color,
-                'fillOpacity': 0.8,
-                'weight': 1,
-                'color': color,
-                'stroke': 'false',
-                'fill': 'true',
-                'radius': 10
-            }
+        'properties': create_feature_properties(date=date, color=color, popuptext=popuptext)
+    }
+
+
+def create_feature_properties(date: str, color: str, popuptext: str, end_date: str = None) -> dict:
+    """
+    Properties of a timestamped circle feature in the GEOJSON format.
+    :param date:
+    :param color: hexadecimal string
+    :param popuptext: appears when clicking on the monitoring site
+    :param end_date: if given, the feature has a [date, end_date] time range instead of a single date
+    :return: dictionary object that represents a json structure
+    """
+    timestamp = {'times': [date, end_date]} if end_date else {'time': date}
+
+    return {
+        **timestamp,
+        # 'style': {'color': color},
+        'icon': 'circle',
+        'popup': popuptext,
+        'iconstyle': {
+            'fillColor': color,
+            'fillOpacity': 0.8,
+            'weight': 1,
+            'color': color,
+            'stroke': 'false',
+            'fill': 'true',
+            'radius': 10
         }
     }
 
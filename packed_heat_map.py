@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+
+import numpy as np
+
+from folium.plugins import HeatMapWithTime
+
+
+def pack_frames(frames) -> str:
+    """
+    Quantize heatmap weights to uint8 and encode them as a base64 string.
+
+    Weights in [0, 1] map to 1..255, missing values (NaN) map to 0.
+    :param frames: 2D array of shape (n_times, n_sites)
+    :return: base64 string of the row-major uint8 values
+    """
+    frames = np.asarray(frames, dtype=float)
+    valid = ~np.isnan(frames)
+
+    packed = np.zeros(frames.shape, dtype=np.uint8)
+    packed[valid] = 1 + np.rint(np.clip(frames[valid], 0, 1) * 254).astype(np.uint8)
+
+    return base64.b64encode(packed.tobytes()).decode('ascii')
+
+
+class PackedHeatMapWithTime(HeatMapWithTime):
+    """
+    A HeatMapWithTime layer that sends site coordinates only once.
+
+    The regular HeatMapWithTime repeats [lat, lng, weight] for every point in
+    every frame. Here the weights of all frames are quantized to uint8 (256
+    levels) and embedded as a single base64 typed array, which a small JS shim
+    decodes frame by frame when the time dimension asks for it.
+
+    Parameters
+    ----------
+    coordinates: list of [lat, lng]
+        Location of every site, in the same order as the columns of frames.
+    frames: 2D array of shape (n_times, n_sites)
+        Weight of each site at each time step, in the [0, 1] range. Use NaN
+        where a site has no value, so it is left out of that frame.
+    index: Index giving the label (or timestamp) of the rows of frames.
+    **kwargs:
+        Any other HeatMapWithTime option (name, radius, min_speed, ...).
+
+    Examples
+    --------
+    >>> PackedHeatMapWithTime([[51.5, -0.1], [51.6, -0.2]],
+    ...                       [[0.2, np.nan], [0.4, 1.0]],
+    ...                       index=['2021-01-04', '2021-01-11'])
+
+    """
+    _decoder = """(function(coords, packed, nSites) {
+            var bytes = Uint8Array.from(atob(packed), function(c) { return c.charCodeAt(0); });
+            var nFrames = nSites ? bytes.length / nSites : 0;
+            return new Proxy([], {
+                get: function(target, prop) {
+                    if (prop === 'length') { return nFrames; }
+                    if (typeof prop !== 'string' || !/^[0-9]+$/.test(prop) || Number(prop) >= nFrames) {
+                        return target[prop];
+                    }
+                    var values = bytes.subarray(Number(prop) * nSites, (Number(prop) + 1) * nSites);
+                    var frame = [];
+                    for (var s = 0; s < nSites; s++) {
+                        if (values[s] > 0) {
+                            frame.push([coords[s][0], coords[s][1], (values[s] - 1) / 254]);
+                        }
+                    }
+                    return frame;
+                }
+            });
+        })(%s, "%s", %d)"""
+
+    def __init__(self, coordinates, frames, index=None, **kwargs):
+        frames = np.asarray(frames, dtype=float).reshape(-1, len(coordinates))
+        # empty placeholder frames, the real data is replaced by the decoder below
+        super(PackedHeatMapWithTime, self).__init__([[]] * len(frames), index=index, **kwargs)
+        self._name = 'PackedHeatMap'
+
+        self.coordinates = [[round(float(lat), 6), round(float(lng), 6)] for lat, lng in coordinates]
+        self.data = self._decoder % (json.dumps(self.coordinates), pack_frames(frames), len(self.coordinates))
+
+    def _get_self_bounds(self):
+        """
+        Computes the bounds of the object itself (not including it's children)
+        in the form [[lat_min, lon_min], [lat_max, lon_max]].
+
+        """
+        if not self.coordinates:
+            return [[None, None], [None, None]]
+
+        lats, lngs = zip(*self.coordinates)
+        return [[min(lats), min(lngs)], [max(lats), max(lngs)]]
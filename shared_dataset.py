@@ -0,0 +1,224 @@
+"""
+Read-only site data per pollutant, shared between processes through memory mapped files.
+
+The hourly sites x time matrix and its weekly and daily means are built once from the csv files in the data folder
+and saved as .npy files. Every process (e.g. each gunicorn worker) then memory maps the same files,
+so the operating system keeps a single copy of the data in memory, however many workers there are.
+This works both for workers forked from a preloaded app and for independently started workers.
+
+Every build is saved in its own folder and the json index of the pollutant points to the current one, so a
+rebuild never changes files that other processes have mapped: they switch over when the index is replaced.
+Only one process at a time (re)builds a dataset, the others wait for it and then use its result.
+"""
+
+import json
+import os
+import shutil
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from analysis import site_matrix
+from dataloading import load_from_file
+from instrumentation import span
+
+try:  # not available on Windows, builds are then not locked
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DATASET_DIR = os.environ.get("LDN_DATASET_DIR", "./dataset_cache")
+DATASET_FORMAT = 3  # saved datasets with another format are rebuilt
+
+# key = pandas period frequency, value = name of the aggregate in the files and SpeciesDataset
+AGGREGATES = {"W": "weekly", "D": "daily"}
+
+# site_codes: rows of the matrices, times: DatetimeIndex of the hourly columns,
+# weeks / days: start date per weekly / daily column
+SpeciesDataset = namedtuple("SpeciesDataset", ["site_codes", "times", "hourly", "weeks", "weekly", "days", "daily"])
+
+_open_datasets = {}  # key = species code, value = (data version, SpeciesDataset) mapped by this process
+
+
+def _data_version(data_path: str, info_path: str) -> float:
+    """
+    Latest modification time of the site data and site info, to know when a saved dataset is outdated.
+    """
+    mtimes = [entry.stat().st_mtime for entry in os.scandir(data_path)]
+    return max(mtimes + [os.path.getmtime(info_path)])
+
+
+def _save_atomic(path: str, save_func):
+    """
+    Writes to a temporary file first, so other processes never read a half written file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_func(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _read_index(index_path: str):
+    """
+    Index of a saved dataset, or None if there is none.
+    """
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+def _is_current(index, version: float) -> bool:
+    return index is not None and index.get("format") == DATASET_FORMAT and index["version"] == version
+
+
+@contextmanager
+def _build_lock(dataset_dir: str, species_code: str):
+    """
+    Exclusive lock on the dataset of a pollutant, held while it is being built.
+    """
+    os.makedirs(dataset_dir, exist_ok=True)
+    with open(os.path.join(dataset_dir, f"{species_code}.lock"), "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+        yield
+
+
+def build_species_dataset(species_code: str, sites_dict: dict = None, data_path: str = "./data",
+                          dataset_dir: str = None):
+    """
+    Saves the hourly, weekly and daily matrices of a pollutant as .npy files in a new folder, then points the
+    json index of the pollutant to it. Builds older than the one that is replaced are removed.
+    :param species_code: options are NO2, O3, PM10, SO2, PM25, CO
+    :param sites_dict: site data as returned by load_from_file(), only the column of the pollutant is loaded from
+    data_path if not given
+    :param data_path: location of data folder
+    :param dataset_dir: folder to save the dataset in, defaults to DATASET_DIR
+    :return:
+    """
+    from mapmaking import get_col_name, get_sites_by_pollutant
+
+    dataset_dir = dataset_dir or DATASET_DIR
+    index_path = os.path.join(dataset_dir, f"{species_code}_index.json")
+
+    version = _data_version(data_path, "./helper_files/monitoring.json")
+
+    if sites_dict is None:
+        sites_dict = load_from_file(data_path, columns=[get_col_name(species_code)])
+
+    codes, times, hourly = site_matrix(sites_dict, get_col_name(species_code),
+                                       site_codes=get_sites_by_pollutant(species_code))
+
+    # nobody reads from a new folder until the index points to it, so the files can be written directly
+    build_dir = f"{species_code}_{uuid.uuid4().hex}"
+    os.makedirs(os.path.join(dataset_dir, build_dir))
+
+    def save_npy(name, array):
+        np.save(os.path.join(dataset_dir, build_dir, f"{name}.npy"), np.ascontiguousarray(array, dtype=float))
+
+    save_npy("hourly", hourly)
+
+    index = {"format": DATASET_FORMAT,
+             "version": version,
+             "dir": build_dir,
+             "site_codes": codes,
+             "start": str(times[0]) if len(times) else None,
+             "hours": len(times)}
+
+    hourly_df = pd.DataFrame(hourly.T, index=times)
+    for freq, name in AGGREGATES.items():
+        with span("aggregate"):
+            # weekly or daily means for all sites at once
+            aggregate_df = hourly_df.groupby(times.to_period(freq)).mean()
+
+        save_npy(name, aggregate_df.to_numpy().T)
+        index[f"{name}_start_dates"] = list(aggregate_df.index.start_time.strftime("%Y-%m-%d"))
+
+    previous = _read_index(index_path)
+
+    def save_index(path):
+        with open(path, "w") as f:
+            json.dump(index, f)
+
+    # switching to the new build is a single rename of the index
+    _save_atomic(index_path, save_index)
+
+    # the previous build may still be opened by a process that read the old index, keep that one
+    keep = {build_dir, previous.get("dir") if previous else None}
+    for entry in os.scandir(dataset_dir):
+        if entry.is_dir() and entry.name.startswith(f"{species_code}_") and entry.name not in keep:
+            shutil.rmtree(entry.path, ignore_errors=True)  # mapped files stay readable until they are unmapped
+
+
+def open_species_dataset(species_code: str, data_path: str = "./data", dataset_dir: str = None,
+                         load_sites=None) -> SpeciesDataset:
+    """
+    Memory maps the saved dataset of a pollutant, (re)building it first if it is missing or outdated.
+    The arrays are read-only, copy them before making changes.
+    :param species_code: options are NO2, O3, PM10, SO2, PM25, CO
+    :param data_path: location of data folder
+    :param dataset_dir: folder the dataset is saved in, defaults to DATASET_DIR
+    :param load_sites: function returning the site data to build from, to share one load between pollutants.
+    Only called if the dataset has to be built, by default the csv files are read for this pollutant only
+    :return: SpeciesDataset with the site codes, hourly times and matrix, and the start dates and matrices of
+    the weekly and daily means
+    """
+    dataset_dir = dataset_dir or DATASET_DIR
+    index_path = os.path.join(dataset_dir, f"{species_code}_index.json")
+
+    version = _data_version(data_path, "./helper_files/monitoring.json")
+
+    if species_code in _open_datasets and _open_datasets[species_code][0] == version:
+        return _open_datasets[species_code][1]
+
+    index = _read_index(index_path)
+
+    if not _is_current(index, version):
+        with _build_lock(dataset_dir, species_code):
+            index = _read_index(index_path)  # another process may have built it while we were waiting
+            if not _is_current(index, version):
+                with span("build dataset"):
+                    build_species_dataset(species_code, sites_dict=load_sites() if load_sites else None,
+                                          data_path=data_path, dataset_dir=dataset_dir)
+                index = _read_index(index_path)
+
+    build_dir = os.path.join(dataset_dir, index["dir"])
+    with span("open dataset"):
+        dataset = SpeciesDataset(
+            site_codes=index["site_codes"],
+            times=pd.date_range(index["start"], periods=index["hours"], freq=pd.Timedelta(hours=1)),
+            hourly=np.load(os.path.join(build_dir, "hourly.npy"), mmap_mode="r"),
+            weeks=index["weekly_start_dates"],
+            weekly=np.load(os.path.join(build_dir, "weekly.npy"), mmap_mode="r"),
+            days=index["daily_start_dates"],
+            daily=np.load(os.path.join(build_dir, "daily.npy"), mmap_mode="r"),
+        )
+
+    _open_datasets[species_code] = (version, dataset)
+
+    return dataset
+
+
+def open_species_datasets(species_codes: list, data_path: str = "./data", dataset_dir: str = None) -> dict:
+    """
+    Opens the datasets of several pollutants. The csv files are read at most once, with only the columns
+    of these pollutants, however many of the datasets have to be (re)built.
+    :param species_codes: options are NO2, O3, PM10, SO2, PM25, CO
+    :param data_path: location of data folder
+    :param dataset_dir: folder the datasets are saved in, defaults to DATASET_DIR
+    :return: dictionary where key = species code, and value = SpeciesDataset
+    """
+    from mapmaking import get_col_name
+
+    loaded = []  # site data, once it has been read
+
+    def load_sites():
+        if not loaded:
+            loaded.append(load_from_file(data_path, columns=[get_col_name(x) for x in species_codes]))
+        return loaded[0]
+
+    return {species_code: open_species_dataset(species_code, data_path=data_path, dataset_dir=dataset_dir,
+                                               load_sites=load_sites)
+            for species_code in species_codes}
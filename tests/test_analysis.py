@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from analysis import exceedance_counts, matrix_statistics, rolling_mean
+
+
+def random_matrix(n_sites=5, n_hours=24 * 10 + 7, nan_fraction=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.uniform(0, 60, (n_sites, n_hours))
+    matrix[rng.random(matrix.shape) < nan_fraction] = np.nan
+    times = pd.date_range("2021-01-01 05:00", periods=n_hours, freq=pd.Timedelta(hours=1))
+    return times, matrix
+
+
+def test_rolling_mean_matches_pandas():
+    times, matrix = random_matrix()
+
+    for window in (8, 24):
+        expected = pd.DataFrame(matrix.T).rolling(window, min_periods=int(np.ceil(window * 0.75))).mean()
+        np.testing.assert_allclose(rolling_mean(matrix, window), expected.to_numpy().T)
+
+
+def test_one_hour_limits_count_hours():
+    times = pd.date_range("2021-01-01", periods=48, freq=pd.Timedelta(hours=1))
+    matrix = np.full((1, 48), 10.0)
+    matrix[0, [1, 2, 30]] = 250  # three hours on two days
+
+    assert exceedance_counts(matrix, times, 200, window=1).tolist() == [3]
+
+
+def test_daily_limits_count_calendar_days():
+    times, matrix = random_matrix()
+
+    for i, row in enumerate(matrix):
+        series = pd.Series(row, index=times)
+        day_means = series.resample("D").agg(lambda x: x.mean() if x.notna().sum() >= 18 else np.nan)
+        max_8h_means = series.rolling(8, min_periods=6).mean().resample("D").max()
+
+        assert exceedance_counts(matrix, times, 30, window=24)[i] == (day_means > 30).sum()
+        assert exceedance_counts(matrix, times, 30, window=8)[i] == (max_8h_means > 30).sum()
+
+
+def test_matrix_statistics_units_and_blocks():
+    times, matrix = random_matrix(n_sites=7)
+    codes = [f"S{i}" for i in range(7)]
+
+    stats = matrix_statistics(codes, times, matrix, "NO2", block_size=3)
+
+    assert [x["counted_in"] for x in stats["limits"]] == ["hours", "days"]
+    assert stats == matrix_statistics(codes, times, matrix, "NO2", block_size=32)
+    assert stats["sites"]["S0"]["hours_measured"] == np.sum(~np.isnan(matrix[0]))
+
+
+def test_matrix_statistics_without_data():
+    empty_site = np.full((1, 48), np.nan)
+    times = pd.date_range("2021-01-01", periods=48, freq=pd.Timedelta(hours=1))
+
+    stats = matrix_statistics(["A"], times, empty_site, "O3")
+    assert stats["sites"]["A"]["max_8h_mean"] is None
+    assert stats["sites"]["A"]["exceedances"] == {"UK 8-hour mean": 0}
+
+    stats = matrix_statistics(["A", "B"], pd.DatetimeIndex([]), np.empty((2, 0)), "NO2")  # no columns at all
+    assert stats["sites"]["B"]["latest_24h_mean"] is None
+    assert stats["start"] is None
@@ -0,0 +1,92 @@
+import os
+
+import pytest
+import requests
+
+import http_cache
+
+URL = "https://api.erg.ic.ac.uk/AirQuality/Data/Site/SiteCode=BG1"
+
+
+class FakeResponse:
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Replaces the API with a list of responses (or exceptions), and records the request headers.
+    """
+    calls = []
+    responses = []
+
+    def fake_get(url, headers=None, timeout=None):
+        calls.append(headers)
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(http_cache.requests, "get", fake_get)
+    return calls, responses
+
+
+def test_fresh_response_is_served_from_the_cache(api, tmp_path):
+    calls, responses = api
+    responses.append(FakeResponse(200, "data", {"ETag": '"v1"'}))
+
+    assert http_cache.cached_get(URL, cache_dir=str(tmp_path)) == (200, "data", True)
+    assert http_cache.cached_get(URL, cache_dir=str(tmp_path)) == (200, "data", False)
+    assert len(calls) == 1
+
+
+def test_outdated_response_is_revalidated(api, tmp_path):
+    calls, responses = api
+    responses += [FakeResponse(200, "data", {"ETag": '"v1"'}), FakeResponse(304)]
+
+    http_cache.cached_get(URL, ttl=0, cache_dir=str(tmp_path))
+    assert http_cache.cached_get(URL, ttl=0, cache_dir=str(tmp_path)) == (200, "data", True)
+    assert calls[1]["If-None-Match"] == '"v1"'
+
+
+def test_stale_response_is_used_when_the_api_fails(api, tmp_path):
+    calls, responses = api
+    responses += [FakeResponse(200, "data"), FakeResponse(503), requests.ConnectionError()]
+
+    http_cache.cached_get(URL, ttl=0, cache_dir=str(tmp_path))
+    assert http_cache.cached_get(URL, ttl=0, cache_dir=str(tmp_path)) == (200, "data", False)
+    assert http_cache.cached_get(URL, ttl=0, cache_dir=str(tmp_path)) == (200, "data", False)
+
+
+def test_failed_responses_are_not_cached(api, tmp_path):
+    calls, responses = api
+    responses += [FakeResponse(503), FakeResponse(200, "data")]
+
+    assert http_cache.cached_get(URL, cache_dir=str(tmp_path)) == (503, "", True)
+    assert http_cache.cached_get(URL, cache_dir=str(tmp_path)) == (200, "data", True)
+
+
+def test_offline_uses_only_the_cache(api, tmp_path):
+    calls, responses = api
+    responses.append(FakeResponse(200, "data"))
+
+    assert http_cache.cached_get(URL, offline=True, cache_dir=str(tmp_path)) == (504, "", False)
+    http_cache.cached_get(URL, cache_dir=str(tmp_path))
+    assert http_cache.cached_get(URL, ttl=0, offline=True, cache_dir=str(tmp_path)) == (200, "data", False)
+    assert len(calls) == 1
+
+
+def test_least_recently_used_responses_are_evicted(api, tmp_path):
+    calls, responses = api
+    responses += [FakeResponse(200, "a" * 100), FakeResponse(200, "b" * 100)]
+
+    http_cache.cached_get(URL + "1", cache_dir=str(tmp_path))
+    http_cache.cached_get(URL + "2", cache_dir=str(tmp_path))
+    os.utime(http_cache._paths(URL + "1", str(tmp_path))[1], (1, 1))  # used longest ago
+    http_cache.evict(str(tmp_path), max_bytes=150)
+
+    assert http_cache.cached_get(URL + "1", offline=True, cache_dir=str(tmp_path))[0] == 504
+    assert http_cache.cached_get(URL + "2", offline=True, cache_dir=str(tmp_path))[1] == "b" * 100
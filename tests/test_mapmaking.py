@@ -0,0 +1,39 @@
+import numpy as np
+
+from mapmaking import bin_changes
+
+
+def test_bin_changes_finds_periods_with_the_same_bin():
+    values = np.array([1.0, 1.5, 9.0, 9.5, 1.0])
+
+    starts, ends, bins = bin_changes(values, np.ones(5, dtype=bool), min_val=0, max_val=10, n_bins=2)
+
+    assert starts.tolist() == [0, 2, 4]
+    assert ends.tolist() == [1, 3, 4]
+    assert bins.tolist() == [0, 1, 0]
+
+
+def test_bin_changes_carries_bins_over_missing_values():
+    values = np.array([1.0, np.nan, 1.2, np.nan, 9.0, np.nan])
+    valid = ~np.isnan(values)
+
+    starts, ends, bins = bin_changes(values, valid, min_val=0, max_val=10, n_bins=2)
+
+    assert starts.tolist() == [0, 4]
+    assert ends.tolist() == [3, 4]  # the last period ends at the last valid value
+    assert bins.tolist() == [0, 1]
+
+
+def test_bin_changes_clips_to_the_outer_bins():
+    values = np.array([-5.0, 10.0, 50.0])
+
+    starts, ends, bins = bin_changes(values, np.ones(3, dtype=bool), min_val=0, max_val=10, n_bins=4)
+
+    assert bins.tolist() == [0, 3]
+    assert starts.tolist() == [0, 1]
+
+
+def test_bin_changes_without_valid_values():
+    starts, ends, bins = bin_changes(np.full(3, np.nan), np.zeros(3, dtype=bool), min_val=0, max_val=1, n_bins=4)
+
+    assert len(starts) == len(ends) == len(bins) == 0
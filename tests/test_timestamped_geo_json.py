@@ -0,0 +1,49 @@
+import json
+import tempfile
+
+import pytest
+
+from timestamped_geo_json import GeoJsonFeatureWriter
+
+
+def test_writer_serializes_a_feature_collection():
+    writer = GeoJsonFeatureWriter()
+    writer.write_points([51.5, 51.6], [-0.1, -0.2], [{"time": "2021-01-01"}, {"time": "2021-01-08"}])
+    writer.write_feature({"type": "Feature", "properties": {},
+                          "geometry": {"type": "LineString", "coordinates": [[-0.3, 51.4], [0.1, 51.7]]}})
+
+    collection = json.loads(writer.getvalue())
+
+    assert collection["type"] == "FeatureCollection"
+    assert [x["geometry"]["type"] for x in collection["features"]] == ["Point", "Point", "LineString"]
+    assert collection["features"][0]["geometry"]["coordinates"] == [-0.1, 51.5]
+    assert collection["features"][1]["properties"] == {"time": "2021-01-08"}
+    assert writer.count == 3
+    assert writer.bounds == [[51.4, -0.3], [51.7, 0.1]]
+
+
+def test_writer_without_features():
+    writer = GeoJsonFeatureWriter()
+    writer.write_points([], [], [])
+
+    assert json.loads(writer.getvalue()) == {"type": "FeatureCollection", "features": []}
+    assert writer.bounds == [[None, None], [None, None]]
+
+
+def test_writer_can_only_be_read_once():
+    writer = GeoJsonFeatureWriter()
+    writer.getvalue()
+
+    with pytest.raises(ValueError):
+        writer.getvalue()
+    with pytest.raises(ValueError):
+        writer.write_points([51.5], [-0.1], [{}])
+
+
+def test_writer_to_a_file():
+    with tempfile.TemporaryFile("w+") as f:
+        writer = GeoJsonFeatureWriter(f)
+        writer.write_points([51.5], [-0.1], [{"time": "2021-01-01"}])
+
+        assert len(json.loads(writer.getvalue())["features"]) == 1
+        assert not f.closed  # files are left to the caller
@@ -1,17 +1,136 @@
 # -*- coding: utf-8 -*-
 
+import io
 import json
 
 from branca.element import MacroElement
 
 from folium.elements import JSCSSMixin
 from folium.folium import Map
-from folium.utilities import parse_options, get_bounds
+from folium.utilities import parse_options, get_bounds, none_min, none_max
 from folium.map import Layer
 
 from jinja2 import Template
 
 
+class GeoJsonFeatureWriter(object):
+    """
+    Incrementally serializes GeoJSON features into a FeatureCollection.
+
+    Features are written straight into a text buffer (or an open file) as they
+    are generated, so the full collection never has to exist as Python dicts.
+    Bounds are tracked while writing, which means they don't have to be
+    recomputed by parsing the serialized collection afterwards.
+
+    The collection is embedded in the map html, so it is always read back as a
+    single string by getvalue(). Writing to a file therefore doesn't lower the
+    peak memory beyond not keeping the feature dicts; it only moves the partial
+    collection out of memory while the features are being written.
+
+    Parameters
+    ----------
+    buffer: file-like, default None
+        Text buffer to write to. If None, an in-memory io.StringIO is used.
+        Files should be opened in 'w+' mode so the result can be read back.
+        The writer releases (and, for its own StringIO, closes) the buffer in
+        getvalue(), so only the returned string stays in memory.
+
+    Examples
+    --------
+    >>> writer = GeoJsonFeatureWriter()
+    >>> writer.write_points([51.5, 51.6], [-0.1, -0.2],
+    ...                     [{'time': '2021-01-01'}, {'time': '2021-01-08'}])
+    >>> TimestampedGeoJson(writer)
+
+    """
+
+    def __init__(self, buffer=None):
+        self.buffer = io.StringIO() if buffer is None else buffer
+        self._own_buffer = buffer is None
+        self.buffer.write('{"type": "FeatureCollection", "features": [')
+        self.count = 0
+        self.closed = False
+        self.bounds = [[None, None], [None, None]]  # [[lat_min, lon_min], [lat_max, lon_max]]
+
+    def _update_bounds(self, lat_min, lon_min, lat_max, lon_max):
+        self.bounds = [
+            [none_min(self.bounds[0][0], lat_min), none_min(self.bounds[0][1], lon_min)],
+            [none_max(self.bounds[1][0], lat_max), none_max(self.bounds[1][1], lon_max)],
+        ]
+
+    def _write(self, feature_str: str):
+        if self.closed:
+            raise ValueError('Cannot write features to a closed GeoJsonFeatureWriter.')
+
+        if self.count:
+            self.buffer.write(', ')
+        self.buffer.write(feature_str)
+        self.count += 1
+
+    def write_feature(self, feature: dict):
+        """
+        Serialize a single GeoJSON feature of any geometry type.
+        :param feature: dictionary in the GeoJSON Feature format
+        :return:
+        """
+        if feature['geometry']['type'] == 'Point':
+            long, lat = feature['geometry']['coordinates'][:2]
+            self._update_bounds(lat, long, lat, long)
+        else:
+            (lat_min, lon_min), (lat_max, lon_max) = get_bounds(feature, lonlat=True)
+            self._update_bounds(lat_min, lon_min, lat_max, lon_max)
+
+        self._write(json.dumps(feature))
+
+    def write_points(self, lats, longs, properties):
+        """
+        Serialize Point features from coordinate arrays, without building feature dicts.
+        :param lats: sequence of latitudes
+        :param longs: sequence of longitudes, same length as lats
+        :param properties: iterable of property dictionaries, one per point
+        :return:
+        """
+        if not len(lats):
+            return
+
+        self._update_bounds(float(min(lats)), float(min(longs)), float(max(lats)), float(max(longs)))
+
+        for lat, long, props in zip(lats, longs, properties):
+            self._write('{"type": "Feature", "geometry": {"type": "Point", "coordinates": [%r, %r]}, '
+                        '"properties": %s}' % (float(long), float(lat), json.dumps(props)))
+
+    def close(self):
+        """
+        Terminate the FeatureCollection. No features can be written afterwards.
+        :return:
+        """
+        if not self.closed:
+            self.buffer.write(']}')
+            self.closed = True
+
+    def getvalue(self) -> str:
+        """
+        Close the collection and return it as a string. The buffer is released
+        afterwards, so this can only be called once.
+        :return: the serialized FeatureCollection
+        """
+        if self.buffer is None:
+            raise ValueError('The collection of this GeoJsonFeatureWriter was already read.')
+
+        self.close()
+        if hasattr(self.buffer, 'getvalue'):
+            value = self.buffer.getvalue()
+            if self._own_buffer:
+                self.buffer.close()  # frees the StringIO copy
+        else:
+            self.buffer.flush()
+            self.buffer.seek(0)
+            value = self.buffer.read()
+
+        self.buffer = None
+        return value
+
+
 class TimestampedGeoJson(JSCSSMixin, Layer):
     """
     Creates a TimestampedGeoJson plugin from timestamped GeoJSONs to append
@@ -31,9 +150,11 @@ class TimestampedGeoJson(JSCSSMixin, Layer):
 
     Parameters
     ----------
-    data: file, dict or str.
+    data: file, dict, str or GeoJsonFeatureWriter.
         The timestamped geo-json data you want to plot.
 
+        * If GeoJsonFeatureWriter, then the collection it serialized will be
+          embedded, and the bounds it tracked are reused.
         * If file, then data will be read in the file and fully embedded in
           Leaflet's javascript.
         * If dict, then data will be converted to json and embedded in the
@@ -56,6 +177,11 @@ class TimestampedGeoJson(JSCSSMixin, Layer):
         time has passed. If None, all previous times will be shown.
         Format: ISO8601 Duration
         ex: 'P1M' 1/month, 'P1D' 1/day, 'PT1H' 1/hour, and 'PT1M' 1/minute
+    update_time_dimension_mode: str, default None
+        How the feature times set the available times of the time slider.
+        Use 'extremes' to get every period between the first and last time,
+        e.g. when features have a 'times' property of [start, end].
+        If None, the option is left out and the TimeDimension default is used.
 
     Examples
     --------
@@ -132,6 +258,9 @@ class TimestampedGeoJson(JSCSSMixin, Layer):
                 geoJsonLayer,
                 {
                     updateTimeDimension: true,
+                    {% if this.update_time_dimension_mode %}
+                    updateTimeDimensionMode: {{ this.update_time_dimension_mode|tojson }},
+                    {% endif %}
                     addlastPoint: {{ this.add_last_point|tojson }},
                     duration: {{ this.duration }},
                 }
@@ -163,16 +292,23 @@ class TimestampedGeoJson(JSCSSMixin, Layer):
                  add_last_point=True, period='P1D', min_speed=0.1, max_speed=10,
                  loop_button=False, date_options='YYYY-MM-DD HH:mm:ss',
                  time_slider_drag_update=False, duration=None, speed_step=0.1,
+                 update_time_dimension_mode=None,
                  overlay=True, control=True, name=None, show=True):
         super(TimestampedGeoJson, self).__init__(name=name, overlay=overlay, control=control, show=show)
         self._name = 'TimestampedGeoJson'
+        self._bounds = None
 
-        if 'read' in dir(data):
+        if isinstance(data, GeoJsonFeatureWriter):
+            self.embed = True
+            self.data = data.getvalue()
+            self._bounds = data.bounds
+        elif 'read' in dir(data):
             self.embed = True
             self.data = data.read()
         elif type(data) is dict:
             self.embed = True
             self.data = json.dumps(data)
+            self._bounds = get_bounds(data, lonlat=True)
         else:
             self.embed = False
             self.data = data
@@ -180,6 +316,7 @@ class TimestampedGeoJson(JSCSSMixin, Layer):
         self.period = period
         self.date_options = date_options
         self.duration = 'undefined' if duration is None else '"' + duration + '"'
+        self.update_time_dimension_mode = update_time_dimension_mode
 
         self.options = parse_options(
             position='bottomleft',
@@ -211,6 +348,9 @@ class TimestampedGeoJson(JSCSSMixin, Layer):
         if not self.embed:
             raise ValueError('Cannot compute bounds of non-embedded GeoJSON.')
 
+        if self._bounds is not None:  # already known, no need to parse the data again
+            return self._bounds
+
         data = json.loads(self.data)
         if 'features' not in data.keys():
             # Catch case when GeoJSON is just a single Feature or a geometry.